@@ -4,10 +4,27 @@ import json
 import os
 import time
 import platform
+import ipaddress
+import select
+import shlex
+import socket
 
 from pathlib import Path
 from loguru import logger
 
+try:
+    # Optional: schnellerer JSON-Parser, fällt sonst auf die Standardbibliothek zurück
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional: ip-rules direkt per Netlink setzen statt das ip-Programm zu starten
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+except ImportError:
+    IPRoute = None
+
 
 def get_base_dir() -> Path:
     """Bestimmt das Basisverzeichnis, egal ob .py oder .exe."""
@@ -18,9 +35,91 @@ def get_base_dir() -> Path:
     # Wenn das Skript normal läuft (.py)
     return Path(__file__).resolve().parent
 
+def json_loads(data: bytes):
+    """Parst JSON-Bytes, bevorzugt mit orjson."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj) -> bytes:
+    """Kodiert ein Objekt als UTF-8 JSON, bevorzugt mit orjson."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+def helper_command() -> list:
+    """Startbefehl für den privilegierten Helfer, egal ob .py oder .exe."""
+    if getattr(sys, 'frozen', False):
+        return ["sudo", "-n", sys.executable, "--helper"]
+    return ["sudo", "-n", sys.executable, "-u", str(Path(__file__).resolve()), "--helper"]
+
+def netlink_rule(ipr, args: list) -> dict:
+    """
+    Führt 'ip rule add/del ...' direkt per Netlink aus.
+    Gibt None zurück, wenn die Optionen nicht übersetzt werden können.
+    """
+    action, options = args[0], dict(zip(args[1::2], args[2::2]))
+    if action not in ("add", "del") or not set(options) <= {"from", "table", "priority"}:
+        return None
+    if "priority" not in options:
+        # pyroute2 setzt ohne Priorität 32000 ein, das ip-Programm passt dagegen auf jede Priorität
+        return None
+    kwargs = {}
+    try:
+        if "from" in options:
+            network = ipaddress.ip_network(options["from"], strict=False)
+            kwargs["family"] = socket.AF_INET6 if network.version == 6 else socket.AF_INET
+            kwargs["src"] = str(network.network_address)
+            kwargs["src_len"] = network.prefixlen
+        if "table" in options:
+            kwargs["table"] = int(options["table"])
+        if "priority" in options:
+            kwargs["priority"] = int(options["priority"])
+    except ValueError:
+        # z.B. Tabellenname aus rt_tables statt ID
+        return None
+    try:
+        ipr.rule(action, **kwargs)
+        return {"returncode": 0, "stdout": "", "stderr": ""}
+    except NetlinkError as e:
+        # z.B. Regel existiert bereits / nicht vorhanden
+        return {"returncode": 2, "stdout": "", "stderr": str(e)}
+
+def run_helper():
+    """
+    Läuft als root und führt zeilenweise per JSON übergebene Befehle aus.
+    So muss sudo nur einmal statt für jeden Befehl gestartet werden.
+    """
+    # Ein Netlink-Socket für alle ip-rule Befehle dieses Laufs
+    ipr = IPRoute() if IPRoute is not None else None
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+            cmd = request["cmd"]
+            if not cmd or cmd[0] not in HELPER_COMMANDS:
+                raise ValueError(f"Befehl nicht erlaubt: {cmd[:1]}")
+            response = None
+            if ipr is not None and cmd[:2] == ["ip", "rule"] and len(cmd) > 2:
+                response = netlink_rule(ipr, cmd[2:])
+            if response is None:
+                result = subprocess.run(cmd, input=request.get("input"), capture_output=True, text=True, check=False)
+                response = {"returncode": result.returncode, "stdout": result.stdout, "stderr": result.stderr}
+        except Exception as e:
+            response = {"returncode": -1, "stdout": "", "stderr": str(e)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+
 # --- BASIS SETUP ---
 BASE_DIR = get_base_dir()
 BASE_CONFIG_PATH = BASE_DIR / "config.json"
+# Profile, deren Traffic über die VPN Tabelle geroutet wird
+VPN_PROFILES = ("VPN", "Sicher")
+# Eigene Chain für alle Geräte-Regeln, wird aus FORWARD angesprungen
+FORWARD_CHAIN = "VPN_GATEWAY"
+# Programme, die der privilegierte Helfer ausführen darf
+HELPER_COMMANDS = ("ip", "iptables", "ip6tables", "iptables-restore", "sysctl")
+# Netlink Multicast-Gruppe für Link-Änderungen (aus linux/rtnetlink.h)
+RTMGRP_LINK = 1
 
 class GatewayManager:
     def __init__(self, config_path: Path):
@@ -31,28 +130,59 @@ class GatewayManager:
         # VPN Tabelle und lokales Netzwerk aus der Basis-Konfiguration laden
         self.vpn_table = self.base_config.get("vpn_table_id", "100")
         self.local_net = self.base_config.get("local_network", "192.168.178.0/24")
+        self._check_local_net()
         is_linux = platform.system() == "Linux"
         self.dry_run = self.base_config.get("dry_run", True)
         
         # Geräteinformationen laden
         self.devices = self._load_json(self.device_file)
+        # Kanonische Adresse -> gespeicherter Schlüssel, damit z.B. " 10.0.0.2" oder
+        # verschiedene IPv6-Schreibweisen dasselbe Gerät finden
+        self._ip_index = {}
+        for key in self.devices:
+            try:
+                self._ip_index[ipaddress.ip_address(key.strip())] = key
+            except ValueError:
+                logger.warning(f"Ungültige IP-Adresse in {self.device_file}: {key}")
+        # Wird nur bei echten Änderungen gesetzt, damit unveränderte Daten nicht neu geschrieben werden
+        self._dirty = False
+        # Datei ersetzt, aber das Verzeichnis noch nicht per fsync gesichert (siehe flush)
+        self._unsynced = False
+        # Privilegierter Helfer, wird beim ersten Befehl gestartet (False = nicht verfügbar)
+        self._helper = None
+        self.vpn_iface = None
         print(self.dry_run)
         if is_linux is True or self.dry_run != "True":
             self._prepare_system()
+        # Konstante Befehlsteile einmalig aufbauen (benötigt das VPN Interface)
+        self._build_command_templates()
+
+    def _build_command_templates(self):
+        """
+        Baut die konstanten Teile der Befehle einmalig als Tupel auf,
+        pro Aufruf wird dann nur noch die IP eingesetzt.
+        """
+        # Platzhalter (None) werden in apply_profile per Index ersetzt: IP an 5, Priorität an 9
+        self._rule_add_tmpl = ("sudo", "ip", "rule", "add", "from", None, "table", self.vpn_table, "priority", None)
+        # Gleicher Aufbau wie beim Hinzufügen: IP an 5, Priorität an 9
+        self._rule_del_tmpl = ("sudo", "ip", "rule", "del", "from", None, "table", self.vpn_table, "priority", None)
+        # Ohne Priorität (passt auf jede), für unbekannten Zustand und alte Regeln: IP an 5
+        self._rule_del_any_tmpl = ("sudo", "ip", "rule", "del", "from", None, "table", self.vpn_table)
+        self._iptables_tmpl = ("sudo", "iptables")
+        # Vollständig konstant, wird bei jedem Profilwechsel erneut gesetzt
+        self._ip6_policy_cmd = ("sudo", "ip6tables", "-P", "FORWARD", "DROP")
+        # Regeln pro Profil als (Position, Regel ohne "-s <ip>")
+        reject = ("-A", ("-p", "udp", "--dport", "53", "!", "-o", self.vpn_iface, "-j", "REJECT"))
+        drop = ("-I", ("-d", self.local_net, "-j", "DROP"))
+        self._profile_rules = {"VPN": (reject,), "Sicher": (reject, drop)}
 
     def _prepare_system(self):
         logger.info("Starte Initialisierung (WireGuard Modus)...")
 
         # Warten bis WireGuard bereit ist (max 45 Sek)
-        found_iface = None
-        for attempt in range(15):
-            found_iface = self._get_vpn_interface()
-            if found_iface:
-                self.vpn_iface = found_iface
-                logger.success(f"WireGuard Interface '{self.vpn_iface}' ist bereit.")
-                break
-            logger.info(f"Warte auf WireGuard... (Versuch {attempt+1}/15)")
-            time.sleep(3)
+        self.vpn_iface = self._wait_for_vpn_interface(timeout=45)
+        if self.vpn_iface:
+            logger.success(f"WireGuard Interface '{self.vpn_iface}' ist bereit.")
 
         if not self.vpn_iface:
             logger.critical("WireGuard Interface wurde nicht gefunden! Abbruch.")
@@ -61,22 +191,68 @@ class GatewayManager:
         # Infrastruktur mit dem gefundenen Interface setzen
         self._ensure_ip_forwarding()
         self._setup_nat(self.vpn_iface)
+        self._setup_forward_chain()
+
+
+    def _wait_for_vpn_interface(self, timeout: float) -> str:
+        """
+        Wartet ereignisbasiert auf das VPN Interface.
+        Statt alle paar Sekunden zu pollen, wird per Netlink auf neue Links gewartet
+        und nur dann /sys/class/net erneut gelesen.
+        """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK))
+        except (AttributeError, OSError) as e:
+            # Kein Netlink (z.B. nicht Linux): auf einfaches Polling zurückfallen
+            logger.debug(f"Netlink nicht verfügbar ({e}), nutze Polling.")
+            return self._poll_for_vpn_interface(timeout)
 
+        deadline = time.monotonic() + timeout
+        with sock:
+            # Erst nach dem Abonnieren prüfen, damit kein Ereignis verloren geht
+            found_iface = self._get_vpn_interface()
+            if not found_iface:
+                logger.info(f"Warte auf WireGuard... (max {timeout:.0f} Sek)")
+            while not found_iface:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if readable:
+                    try:
+                        sock.recv(65536)
+                    except OSError as e:
+                        # z.B. ENOBUFS bei vielen Link-Ereignissen während des Boots: Ereignisse
+                        # gingen verloren, deshalb unten trotzdem neu scannen
+                        logger.debug(f"Netlink Ereignisse verloren ({e}), prüfe Interfaces erneut.")
+                    found_iface = self._get_vpn_interface()
+        return found_iface
+
+    def _poll_for_vpn_interface(self, timeout: float, interval: float = 3) -> str:
+        """Fallback: Prüft das Interface in festen Abständen."""
+        attempts = max(1, int(timeout // interval))
+        for attempt in range(attempts):
+            found_iface = self._get_vpn_interface()
+            if found_iface:
+                return found_iface
+            logger.info(f"Warte auf WireGuard... (Versuch {attempt+1}/{attempts})")
+            time.sleep(interval)
+        return None
 
     def _load_json(self, path: Path) -> dict:
         """Lädt die Geräte JSON-Datei und gibt deren Inhalt als Dictionary zurück."""
         if not path.exists():
             logger.info(f"Datei nicht gefunden. Erstelle neue Konfiguration unter: {path}")
             try:
-                with open(path, 'w', encoding='utf-8') as f:
-                    json.dump({}, f, indent=4)
+                path.write_bytes(json_dumps({}))
                 return {}
             except Exception as e:
                 logger.error(f"Fehler beim Erstellen der Datei {path}: {e}")
                 return {}
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            # Datei in einem Rutsch lesen und im Speicher parsen
+            return json_loads(path.read_bytes())
         except Exception as e:
             logger.error(f"Fehler beim Laden von {path}: {e}")
             return {}
@@ -87,26 +263,58 @@ class GatewayManager:
             logger.error(f"Konfigurationsdatei {self.config_path} fehlt!")
             return {}
         try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return json_loads(self.config_path.read_bytes())
         except Exception as e:
             logger.error(f"Fehler beim Laden der JSON: {e}")
             return {}
 
     def _save_device_config(self):
-        """Speichert den aktuellen Zustand der Profile in der JSON."""
+        """Speichert den aktuellen Zustand der Profile in der JSON, sofern sich etwas geändert hat."""
+        if not self._dirty:
+            logger.debug("Keine Änderungen, JSON wird nicht geschrieben.")
+            return
         if self.dry_run:
             logger.debug(f"[DRY-RUN] Speichere JSON nach {self.device_file}")
-            with open(self.device_file, 'w') as f:
-                json.dump(self.devices, f, indent=4)
+            self._write_device_file()
         else:
             try:
-                with open(self.device_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.devices, f, indent=4, ensure_ascii=False)
+                self._write_device_file()
                 logger.debug("Konfiguration gespeichert.")
             except Exception as e:
                 logger.error(f"Fehler beim Speichern der JSON: {e}")
 
+    def _write_device_file(self):
+        """
+        Schreibt die Geräte-JSON atomar: erst in eine temporäre Datei, die vor dem Rename
+        per fsync gesichert wird, dann wird das Original ersetzt.
+        Weder ein Abbruch noch ein Stromausfall hinterlassen so eine halbe oder leere Datei.
+        """
+        tmp_file = self.device_file.with_suffix(".json.tmp")
+        with open(tmp_file, 'wb') as f:
+            # Einmal im Speicher kodieren und mit einem write() schreiben
+            f.write(json_dumps(self.devices))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.device_file)
+        self._dirty = False
+        self._unsynced = True
+
+    def flush(self):
+        """Speichert offene Änderungen und sichert das Rename per fsync auf das Verzeichnis."""
+        self._save_device_config()
+        if not self._unsynced:
+            return
+        try:
+            dir_fd = os.open(self.device_file.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self._unsynced = False
+        except OSError as e:
+            # z.B. Windows, dort lassen sich Verzeichnisse nicht öffnen
+            logger.debug(f"fsync nicht möglich: {e}")
+
     def _get_vpn_interface(self) -> str:
         """Findet das aktive WireGuard Interface (z.B. wg0)."""
         try:
@@ -156,68 +364,272 @@ class GatewayManager:
         else:
             logger.debug(f"NAT für {vpn_iface} ist bereits konfiguriert.")
 
-    def _execute(self, cmd: list):
-        """Führt einen Shell-Befehl aus und gibt das Ergebnis zurück."""
+    def _setup_forward_chain(self):
+        """Legt die Chain für die Geräte-Regeln an und springt sie am Anfang von FORWARD an."""
+        check_cmd = ["sudo", "iptables", "-C", "FORWARD", "-j", FORWARD_CHAIN]
+        create_cmd = ["sudo", "iptables", "-N", FORWARD_CHAIN]
+        jump_cmd = ["sudo", "iptables", "-I", "FORWARD", "-j", FORWARD_CHAIN]
+
+        if self.dry_run:
+            logger.info(f"[Dry-Run] Würde Chain {FORWARD_CHAIN} prüfen/anlegen.")
+            return
+
+        check_result = self._execute(check_cmd)
+        if check_result and check_result.returncode != 0:
+            logger.info(f"Chain {FORWARD_CHAIN} nicht eingehängt. Lege an...")
+            # -N schlägt fehl, wenn die Chain schon existiert (nicht kritisch)
+            self._execute(create_cmd)
+            self._execute(jump_cmd)
+            self._remove_legacy_forward_rules()
+        else:
+            logger.debug(f"Chain {FORWARD_CHAIN} ist bereits eingehängt.")
+
+    def _remove_legacy_forward_rules(self):
+        """
+        Entfernt Geräte-Regeln, die ältere Versionen direkt in FORWARD angelegt haben.
+        Läuft nur, wenn die Chain neu eingehängt wird (nach Update oder Reboot).
+        """
+        listing = self._execute(["sudo", "iptables", "-S", "FORWARD"])
+        if not listing or listing.returncode != 0:
+            return
+        sources = {f"{address}/{address.max_prefixlen}" for address in self._ip_index}
+        for line in listing.stdout.splitlines():
+            args = shlex.split(line)
+            if args[:3] != ["-A", "FORWARD", "-s"] or len(args) < 4 or args[3] not in sources:
+                continue
+            target = args[args.index("-j") + 1] if "-j" in args[:-1] else None
+            if target in ("DROP", "REJECT"):
+                logger.info(f"Entferne alte FORWARD-Regel: {line}")
+                self._execute(["sudo", "iptables", "-D", *args[1:]])
+
+    def _execute(self, cmd: list, input: str = None):
+        """Führt einen Shell-Befehl aus und gibt das Ergebnis zurück.
+        Optional wird `input` als Skript über stdin übergeben (z.B. für iptables-restore)."""
         if self.dry_run:
             logger.debug(f"[DRY-RUN] Executing: {cmd}")
+            if input:
+                logger.debug(f"[DRY-RUN] stdin:\n{input}")
             return None # Simuliere Erfolg
         else:
             try:
                 # check=False verhindert den Absturz bei Fehlern (z.B. Regel nicht gefunden)
-                result = subprocess.run(cmd, capture_output=True, text=True, check=False)
+                result = self._run_privileged(cmd, input)
                 if result.returncode != 0:
                     logger.debug(f"Info: Befehl {cmd[1:3]} nicht kritisch: {result.stderr.strip()}")
                 return result
             except Exception as e:
                 logger.error(f"Kritischer Fehler bei Systemaufruf: {e}")
 
+    def _get_helper(self):
+        """Startet den privilegierten Helfer bei Bedarf und gibt ihn zurück."""
+        if self._helper is None:
+            try:
+                # stderr wird nur gelesen, wenn der Helfer ausfällt (z.B. sudo Passwortabfrage, Traceback)
+                self._helper = subprocess.Popen(helper_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE, text=True)
+            except OSError as e:
+                logger.warning(f"Privilegierter Helfer konnte nicht gestartet werden: {e}")
+                self._helper = False
+        return self._helper or None
+
+    def _helper_failure(self, helper) -> str:
+        """Liefert Exit-Status und stderr eines beendeten Helfers für das Log."""
+        try:
+            returncode = helper.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            helper.kill()
+            returncode = helper.wait()
+        stderr = helper.stderr.read().strip() if helper.stderr else ""
+        return f"Exit-Status {returncode}" + (f": {stderr}" if stderr else "")
+
+    def _run_privileged(self, cmd: list, input: str = None) -> subprocess.CompletedProcess:
+        """Schickt sudo-Befehle an den Helfer, fällt sonst auf sudo pro Aufruf zurück."""
+        if cmd[0] == "sudo":
+            helper = self._get_helper()
+            line = ""
+            if helper is not None:
+                try:
+                    helper.stdin.write(json.dumps({"cmd": cmd[1:], "input": input}) + "\n")
+                    helper.stdin.flush()
+                    line = helper.stdout.readline()
+                except OSError:
+                    line = ""
+                if line:
+                    response = json.loads(line)
+                    return subprocess.CompletedProcess(cmd, response["returncode"],
+                                                       response["stdout"], response["stderr"])
+                # z.B. sudo verlangt ein Passwort (-n) und der Helfer hat sich beendet
+                logger.warning(f"Privilegierter Helfer nicht erreichbar ({self._helper_failure(helper)}), "
+                               "nutze sudo pro Aufruf.")
+                self._helper = False
+        return subprocess.run(cmd, input=input, capture_output=True, text=True, check=False)
+
+    def _check_local_net(self):
+        """Warnt, wenn das lokale Netz größer ist, als die ip-rule Prioritäten eindeutig abdecken."""
+        try:
+            network = ipaddress.ip_network(self.local_net, strict=False)
+        except ValueError:
+            logger.warning(f"Ungültiges lokales Netzwerk in der Konfiguration: {self.local_net}")
+            return
+        if network.prefixlen < 18:
+            logger.warning(f"Lokales Netzwerk {self.local_net} ist größer als /18: "
+                           "mehrere Geräte können sich dieselbe ip-rule Priorität teilen.")
+
+    def _rule_priority(self, ip: str) -> int:
+        """
+        Feste ip-rule Priorität pro Gerät, abgeleitet aus der IP (eindeutig innerhalb eines /18).
+        Liegt unter 32766 (main), damit die VPN Tabelle vorher greift.
+        """
+        return 10000 + (int(ipaddress.ip_address(ip)) & 0x3FFF)
+
+    def _forward_rules(self, ip: str, profile: str) -> list:
+        """Liefert die FORWARD-Regeln eines Profils als (Position, Regel) Paare."""
+        return [(position, ("-s", ip) + rule) for position, rule in self._profile_rules.get(profile, ())]
+
+    def _iptables_cmd(self, position: str, rule: tuple) -> list:
+        """Setzt einen iptables Befehl für die Geräte-Chain aus Vorlage und Regel zusammen."""
+        return [*self._iptables_tmpl, position, FORWARD_CHAIN, *rule]
+
     def apply_profile(self, ip: str, profile: str, name: str, update_json:bool):
         """
         Wendet ein Routing-Profil auf eine IP an. 
         Legt das Gerät an, falls es noch nicht existiert.
         """
-        if ip not in self.devices and update_json is True:
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            logger.error(f"Ungültige IP-Adresse: {ip}")
+            return
+        # Regeln immer mit der kanonischen Adresse, die JSON unter dem gespeicherten Schlüssel
+        ip = str(address)
+        key = self._ip_index.get(address, ip)
+
+        # Zuletzt angewendetes Profil, None wenn der Zustand im Kernel unbekannt ist
+        applied = None
+        if key in self.devices and update_json is True:
+            applied = self.devices[key]["profile"]
+            if applied == profile:
+                # Profil ist bereits aktiv: keine Regeln und kein Speichern nötig
+                logger.info(f"Profil '{profile}' ist für {self.devices[key]['name']} ({ip}) bereits aktiv.")
+                return
+
+        # Befehle vollständig aufbauen, bevor self.devices verändert wird
+        commands = []
+        priority = str(self._rule_priority(ip))
+        if applied is None:
+            # Unbekannter Zustand: eventuell vorhandene Regeln entfernen um Konflikte zu vermeiden
+            cmd = list(self._rule_del_any_tmpl)
+            cmd[5] = ip
+            commands.append((cmd, None))
+            for _, rule in self._forward_rules(ip, "Sicher"):
+                commands.append((self._iptables_cmd("-D", rule), None))
+            old_rules = []
+        else:
+            old_rules = self._forward_rules(ip, applied)
+        commands.append((list(self._ip6_policy_cmd), None))
+
+        # Nur die Differenz zwischen altem und neuem Profil anwenden
+        new_rules = self._forward_rules(ip, profile)
+        for position, rule in old_rules:
+            if (position, rule) not in new_rules:
+                commands.append((self._iptables_cmd("-D", rule), None))
+        for position, rule in new_rules:
+            if (position, rule) not in old_rules:
+                commands.append((self._iptables_cmd(position, rule), None))
+
+        # Die Priorität identifiziert die ip-rule des Geräts eindeutig
+        if profile in VPN_PROFILES and applied not in VPN_PROFILES:
+            cmd = list(self._rule_add_tmpl)
+            cmd[5], cmd[9] = ip, priority
+            commands.append((cmd, None))
+        elif profile not in VPN_PROFILES and applied in VPN_PROFILES:
+            # Vollständiger Selektor, damit nie die Regel eines anderen Geräts mit gleicher Priorität fällt
+            cmd = list(self._rule_del_tmpl)
+            cmd[5], cmd[9] = ip, priority
+            # Fallback: Regel aus älteren Versionen ohne feste Priorität
+            fallback = list(self._rule_del_any_tmpl)
+            fallback[5] = ip
+            commands.append((cmd, fallback))
+
+        if key not in self.devices and update_json is True:
             logger.info(f"Neues Gerät erkannt. Initialisiere {ip}...")
-            self.devices[ip] = {"name": name if name else ip, "profile": profile}
+            self.devices[key] = {"name": name if name else ip, "profile": profile}
+            self._ip_index[address] = key
+            self._dirty = True
         elif update_json is True:
             if profile == "Normal":
-                logger.info(f"Setze Profil für {self.devices[ip]['name']} ({ip}) auf 'Normal' und entferne alle Regeln.")
-                self.devices[ip]["profile"] = profile
+                logger.info(f"Setze Profil für {self.devices[key]['name']} ({ip}) auf 'Normal' und entferne alle Regeln.")
             else:
-                logger.info(f"Aktualisiere Profil für {self.devices[ip]['name']} ({ip}) von {self.devices[ip]['profile']} zu {profile}")
-                self.devices[ip]["profile"] = profile
+                logger.info(f"Aktualisiere Profil für {self.devices[key]['name']} ({ip}) von {applied} zu {profile}")
+            self.devices[key]["profile"] = profile
+            self._dirty = True
         else:
             logger.info(f"Initialisiere Profile für {ip}.")
 
-        # Vorherige Regeln entfernen um Konflikte zu vermeiden
-        self._execute(["sudo", "ip", "rule", "del", "from", ip, "table", self.vpn_table])
-        self._execute(["sudo", "iptables", "-D", "FORWARD", "-s", ip, "-d", self.local_net, "-j", "DROP"])
-        self._execute(["sudo", "iptables", "-D", "FORWARD", "-s", ip, "-p", "udp", "--dport", 53, "!", "-o", self.vpn_iface, "-j", "REJECT"])
-        self._execute(["sudo", "ip6tables", "-P", "FORWARD", "DROP"])
+        for cmd, fallback in commands:
+            result = self._execute(cmd)
+            if fallback and result and result.returncode != 0:
+                self._execute(fallback)
 
-        # Neue Regeln basierend auf dem Profil anwenden
-        if profile == "VPN":
-            self._execute(["sudo", "ip", "rule", "add", "from", ip, "table", self.vpn_table])
-            self._execute(["sudo", "iptables", "-A", "FORWARD",  "-s", ip, "-p", "udp", "--dport", 53, "!", "-o", self.vpn_iface, "-j", "REJECT"])
-            
-        elif profile == "Sicher":
-            self._execute(["sudo", "ip", "rule", "add", "from", ip, "table", self.vpn_table])
-            self._execute(["sudo", "iptables", "-A", "FORWARD", "-s", ip, "-p", "udp", "--dport", 53, "!", "-o", self.vpn_iface, "-j", "REJECT"])
-            self._execute(["sudo", "iptables", "-I", "FORWARD", "-s", ip, "-d", self.local_net, "-j", "DROP"])
-        
         if update_json:
             self._save_device_config()
             
-        logger.info(f"Profil '{profile}' aktiv für {self.devices[ip]['name']} ({ip})")
+        logger.info(f"Profil '{profile}' aktiv für {self.devices.get(key, {}).get('name', ip)} ({ip})")
+
+    def _apply_profiles_bulk(self, items: list):
+        """
+        Setzt die Regeln für mehrere Geräte auf einmal.
+        Statt einem Prozess pro Regel werden alle Geräte-Regeln per iptables-restore
+        und alle ip-Rules per ip -batch in jeweils einem Aufruf übergeben.
+        Beides ist wiederholbar: die Geräte-Chain wird dabei neu befüllt,
+        doppelte ip-Rules werden vom Kernel abgelehnt.
+        """
+        filter_lines = []
+        rule_lines = []
+        for ip, profile in items:
+            if profile not in VPN_PROFILES:
+                continue
+            rule_lines.append(f"rule add from {ip} table {self.vpn_table} priority {self._rule_priority(ip)}")
+            for position, rule in self._forward_rules(ip, profile):
+                filter_lines.append(f"{position} {FORWARD_CHAIN} {' '.join(rule)}")
+
+        self._execute(list(self._ip6_policy_cmd))
+        # Immer ausführen, damit auch Regeln entfernter Geräte verschwinden.
+        # -n (noflush) lässt alles andere (z.B. NAT, FORWARD) unangetastet,
+        # die Deklaration der eigenen Chain leert sie vor dem Befüllen.
+        # -w wartet auf den xtables-Lock, falls gerade ein anderer iptables-Aufruf läuft.
+        script = "*filter\n" + f":{FORWARD_CHAIN} - [0:0]\n" + "".join(line + "\n" for line in filter_lines) + "COMMIT\n"
+        result = self._execute(["sudo", "iptables-restore", "-w", "-n"], input=script)
+        if result and result.returncode != 0:
+            logger.error(f"Geräte-Regeln konnten nicht gesetzt werden: {result.stderr.strip()}")
+        if rule_lines:
+            # -force bricht bei einzelnen Fehlern (z.B. Regel existiert) nicht ab
+            self._execute(["sudo", "ip", "-force", "-batch", "-"], input="\n".join(rule_lines) + "\n")
 
     def init_all_devices(self):
-        """Wird beim Reboot gerufen."""
-        for ip, data in self.devices.items():
+        """Wird beim Reboot gerufen, kann aber auch jederzeit erneut ausgeführt werden."""
+        items = []
+        for key, data in self.devices.items():
             current_name = data.get("name", "Unknown")
-            self.apply_profile(ip, data["profile"], name=current_name, update_json=False)
+            try:
+                # Regeln immer mit der kanonischen Adresse, auch bei z.B. " 10.0.0.2" als Schlüssel
+                ip = str(ipaddress.ip_address(key.strip()))
+            except ValueError:
+                logger.warning(f"Überspringe {current_name}: ungültige IP-Adresse '{key}'.")
+                continue
+            logger.info(f"Initialisiere Profil '{data['profile']}' für {current_name} ({ip}).")
+            items.append((ip, data["profile"]))
+        self._apply_profiles_bulk(items)
+        # Höchstens ein Schreibvorgang am Ende, nicht pro Gerät
+        self._save_device_config()
         logger.success("Alle Profile nach Reboot wiederhergestellt.")
 
 if __name__ == "__main__":
+    # Interner Modus: wird per sudo vom GatewayManager gestartet
+    if len(sys.argv) == 2 and sys.argv[1] == "--helper":
+        run_helper()
+        sys.exit(0)
+
     manager = GatewayManager(BASE_CONFIG_PATH)
     if len(sys.argv) == 2 and sys.argv[1] == "--all":
         manager.init_all_devices()
@@ -254,4 +666,7 @@ if __name__ == "__main__":
     else:
         print("Nutzung:")
         print("  python3 script.py --all")
-        print("  python3 script.py <IP> <Profil> [Name]")
\ No newline at end of file
+        print("  python3 script.py <IP> <Profil> [Name]")
+
+    # Änderungen einmalig dauerhaft sichern
+    manager.flush()
\ No newline at end of file